@@ -0,0 +1,61 @@
+class Dialect(object):
+    """SQL that differs between database backends, so helpers can build one statement for either."""
+
+    def advance(self, column, count, unit):
+        """
+        Returns an expression for date column moved forward count units, unit being a frequency modifier
+        ('days', 'months' or 'years'); months and years keep the day of month, clamped to shorter months.
+        column, count and unit are SQL expressions (e.g. columns or :parameters). NULL if unit is NULL.
+        """
+        raise NotImplementedError
+
+    def lock_rows(self, select):
+        """
+        Returns SELECT text locking the rows it reads until the transaction ends, so concurrent writers of the
+        same rows queue behind each other; None if the backend already serializes writers and needs no lock.
+        """
+        raise NotImplementedError
+
+    def schema(self, text):
+        """Returns DDL text (e.g. initialize_db.sql) as a list of statements for this backend, without comments."""
+        import sqlparse
+
+        # a leading comment would hide the statement from SQLAlchemy's autocommit detection
+        text = sqlparse.format(text, strip_comments=True)
+        return [statement.strip() for statement in sqlparse.split(text) if statement.strip()]
+
+
+class PostgresDialect(Dialect):
+
+    def advance(self, column, count, unit):
+        # interval arithmetic clamps to the end of shorter months by itself
+        return "{} + (({})::TEXT || ' ' || {})::INTERVAL".format(column, count, unit)
+
+    def lock_rows(self, select):
+        return "{} FOR UPDATE".format(select)
+
+
+class SQLiteDialect(Dialect):
+
+    def advance(self, column, count, unit):
+        # date()'s month modifiers roll overflowing days forward ('2021-01-31' + 1 month is '2021-03-03'),
+        # so count months from the start of the month and clamp to the target month's last day instead
+        # (NULL for any other unit, so the result is NULL like PostgreSQL's for a NULL interval)
+        months = "(CASE {} WHEN 'years' THEN 12 WHEN 'months' THEN 1 END * ({}))".format(unit, count)
+        return ("CASE WHEN {unit} = 'days' THEN date({column}, '+' || ({count}) || ' days') "
+                "ELSE min(date({column}, 'start of month', '+' || {months} || ' months', "
+                "'+' || (CAST(strftime('%d', {column}) AS INTEGER) - 1) || ' days'), "
+                "date({column}, 'start of month', '+' || ({months} + 1) || ' months', '-1 days')) END"
+                ).format(column=column, count=count, unit=unit, months=months)
+
+    def lock_rows(self, select):
+        # one writer at a time holds the database lock, and a writer's stale read fails rather than overwrites
+        return None
+
+    def schema(self, text):
+        # SQLite assigns keys to INTEGER PRIMARY KEY columns itself
+        return super().schema(text.replace("SERIAL PRIMARY KEY", "INTEGER PRIMARY KEY"))
+
+
+# by SQLAlchemy backend name
+DIALECTS = {"postgres": PostgresDialect(), "postgresql": PostgresDialect(), "sqlite": SQLiteDialect()}
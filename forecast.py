@@ -0,0 +1,80 @@
+import numpy as np
+
+
+def occurrences(items, start, end):
+    """
+    Expands scheduled items into every occurrence due on or before end.
+
+    Each item repeats every repeat * n of its modifier (days, months or years), the same interval
+    posting advances it by (Dialect.advance). The first occurrence is the item's dt (its snoozed date if any)
+    and later ones count from current_dt. Occurrences before start are still outstanding, so they are
+    moved to start. Returns numpy arrays of dates (datetime64[D]), signed amounts and item indexes.
+    """
+    start = np.datetime64(start, "D")
+    end = np.datetime64(end, "D")
+    if not items:
+        return np.array([], dtype="datetime64[D]"), np.array([], dtype=float), np.array([], dtype=np.int64)
+
+    # one array per column, dates may be date objects or ISO strings depending on backend
+    current = np.array([item["current_dt"] for item in items], dtype="datetime64[D]")
+    first = np.array([item["dt"] for item in items], dtype="datetime64[D]")
+    amount = np.array([item["amount"] * item["factor"] for item in items], dtype=float)
+    step = np.array([(item["repeat"] or 0) * (item["n"] or 0) for item in items], dtype=np.int64)
+    modifier = np.array([item["modifier"] or "" for item in items])
+
+    # years step in months, One Time (no modifier) occurs only once
+    step = np.where(modifier == "years", step * 12, step)
+    monthly = (modifier == "months") | (modifier == "years")
+    once = step <= 0
+    safe_step = np.where(once, 1, step)
+
+    # work in day and month numbers since the epoch, month arithmetic keeps the day of month
+    current_day = current.astype(np.int64)
+    current_month = current.astype("datetime64[M]").astype(np.int64)
+    day_of_month = current_day - current_month.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+
+    # number of repeats after the first occurrence, over-counting monthly items by at most one
+    span = np.where(monthly,
+                    end.astype("datetime64[M]").astype(np.int64) - current_month,
+                    end.astype(np.int64) - current_day)
+    counts = 1 + np.where(once, 0, np.maximum(span, 0) // safe_step)
+
+    # flatten into one row per occurrence: index of its item and k steps after current_dt
+    firsts = np.cumsum(counts) - counts
+    index = np.repeat(np.arange(len(items)), counts)
+    k = np.arange(counts.sum()) - np.repeat(firsts, counts)
+    days = current_day[index] + k * safe_step[index]
+
+    # monthly occurrences only: month start plus day of month, clamped to the month's length
+    rows = np.flatnonzero(monthly[index])
+    if rows.size:
+        month = current_month[index[rows]] + k[rows] * safe_step[index[rows]]
+        month_start = month.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+        month_end = (month + 1).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+        days[rows] = np.minimum(month_start + day_of_month[index[rows]], month_end - 1)
+
+    # snoozing moves only the first occurrence
+    days[firsts] = first.astype(np.int64)
+
+    keep = days <= end.astype(np.int64)
+    dates = np.maximum(days[keep], start.astype(np.int64)).astype("datetime64[D]")
+    return dates, amount[index[keep]], index[keep]
+
+
+def project(available, items, start, days, pmt_source="CHK"):
+    """
+    Projects a daily running balance for days days from start, beginning at available.
+
+    Only items paid from pmt_source affect the balance, as with net and next_net on the dashboard.
+    Returns numpy arrays of dates (datetime64[D]), net change per day and balance at end of day.
+    """
+    start = np.datetime64(start, "D")
+    dates = start + np.arange(days)
+
+    # occurrences within the horizon
+    items = [item for item in items if item["pmt_source"] == pmt_source]
+    due, amounts, _ = occurrences(items, start, dates[-1] if days else start - 1)
+
+    # sum per day, then accumulate
+    change = np.bincount((due - start).astype(np.int64), weights=amounts, minlength=days)[:days]
+    return dates, change, available + np.cumsum(change)
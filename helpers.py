@@ -1,9 +1,15 @@
 import csv
-import urllib.request
-from datetime import datetime
+import hmac
+import inspect
+import io
+import json
+import math
+from datetime import date, datetime
 
-from flask import redirect, render_template, request, session
-from functools import wraps
+from flask import abort, current_app, g, jsonify, redirect, render_template, request, session
+from functools import lru_cache, wraps
+
+from snapshots import snapshots
 
 
 def apology(message, code=400):
@@ -28,6 +34,15 @@ def login_required(f):
 
     http://flask.pocoo.org/docs/0.12/patterns/viewdecorators/
     """
+    if inspect.iscoroutinefunction(f):
+        # async views stay coroutine functions, so Flask awaits them
+        @wraps(f)
+        async def decorated_coroutine(*args, **kwargs):
+            if session.get("user_id") is None:
+                return redirect("/login")
+            return await f(*args, **kwargs)
+        return decorated_coroutine
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
@@ -36,6 +51,23 @@ def login_required(f):
     return decorated_function
 
 
+def admin_required(f):
+    """
+    Decorate routes to require the X-Admin-Token header to match ADMIN_TOKEN.
+
+    Routes are hidden (404) when no token is configured.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = current_app.config.get("ADMIN_TOKEN")
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def get_item(db, schedule_id):
     # query database for specific schedule item
     item = db.execute("SELECT A.user_id, A.schedule_id, A.name, A.type_id, A.current_dt, A.snoozed_dt, A.previous_dt, A.frequency_id, A.repeat, A.amount, \
@@ -49,34 +81,65 @@ def get_item(db, schedule_id):
     return item[0]
 
 
-def get_scheduled(db, user_id):
+@lru_cache(maxsize=None)
+def scheduled_query(dialect):
+    # query for a user's open scheduled items, with schedule_type for current, next and future
+    return "SELECT A.user_id, A.schedule_id, A.name, A.type_id, A.current_dt, A.snoozed_dt, A.previous_dt, A.frequency_id, A.repeat, \
+           A.dt, A.pmt_source, A.pmt_method \
+           ,A.amount,CASE WHEN dt < pay_current_dt THEN 'Current' \
+           WHEN dt >= pay_current_dt AND dt < pay_next_dt THEN 'Next' \
+           WHEN dt >= pay_next_dt THEN 'Future' \
+           ELSE 'Unknown' END AS schedule_type \
+           FROM (SELECT *,coalesce(snoozed_dt,current_dt) AS dt FROM schedule WHERE user_id = :user_id AND completed_dt is NULL) A \
+           LEFT JOIN \
+           	(SELECT user_id \
+           	,MIN(current_dt) AS pay_current_dt \
+           	,MIN(" + dialect.advance("current_dt", "repeat * F.n", "modifier") + ") As pay_next_dt \
+           	FROM schedule S \
+           	INNER JOIN frequency F ON S.frequency_id = F.frequency_id \
+           	WHERE user_id = :user_id \
+           	AND type_id = 1 \
+           	AND completed_dt is NULL \
+           	GROUP BY user_id \
+           	) P ON A.user_id = P.user_id \
+           ORDER BY A.Dt;"
+
+
+def get_scheduled(db, user_id, lookups):
     # query database for all scheduled items and use schedule_type for current, next and future
-    scheduled = db.execute("SELECT A.user_id, A.schedule_id, A.name, A.type_id, A.current_dt, A.snoozed_dt, A.previous_dt, A.frequency_id, A.repeat, \
-                           B.label, B.factor, C.frequency, C.modifier, C.n, A.dt, A.pmt_source, D.cd_desc AS pmt_source_desc, A.pmt_method, D2.cd_desc AS pmt_method_desc \
-                           ,A.amount,CASE WHEN dt < pay_current_dt THEN 'Current' \
-                           WHEN dt >= pay_current_dt AND dt < pay_next_dt THEN 'Next' \
-                           WHEN dt >= pay_next_dt THEN 'Future' \
-                           ELSE 'Unknown' END AS schedule_type \
-                           FROM (SELECT *,coalesce(snoozed_dt,current_dt) AS dt FROM schedule) A \
-                           INNER JOIN type B ON A.type_id = B.type_id \
-                           INNER JOIN frequency C ON A.frequency_id = C.frequency_id \
-                           LEFT JOIN \
-                           	(SELECT user_id \
-                           	,MIN(current_dt) AS pay_current_dt \
-                           	,MIN(current_dt + ((repeat * F.n)::TEXT || ' ' || modifier::TEXT)::INTERVAL) As pay_next_dt \
-                           	FROM schedule S \
-                           	INNER JOIN frequency F ON S.frequency_id = F.frequency_id \
-                           	WHERE type_id = 1 \
-                           	AND completed_dt is NULL \
-                           	GROUP BY user_id \
-                           	) P ON A.user_id = P.user_id \
-                           LEFT JOIN cd D ON A.pmt_source = D.cd AND D.cd_group = 'pmt-source' \
-                           LEFT JOIN cd D2 ON A.pmt_method = D2.cd AND D2.cd_group = 'pmt-method' \
-                           WHERE A.user_id = :user_id \
-                           AND completed_dt is NULL \
-                           ORDER BY A.Dt;", user_id=user_id)
-
-    return scheduled
+    return resolve_scheduled(db.execute(scheduled_query(db.dialect), user_id=user_id), lookups)
+
+
+def resolve_scheduled(scheduled, lookups):
+    # resolve type, frequency and code labels from cached lookups instead of joins
+    resolved = []
+    for item in scheduled:
+        type_ = lookups.lookup("types_by_id", item["type_id"])
+        frequency = lookups.lookup("frequencies_by_id", item["frequency_id"])
+
+        # items without a known type or frequency were dropped by the inner joins as well
+        if type_ is None or frequency is None:
+            continue
+
+        item["label"] = type_["label"]
+        item["factor"] = type_["factor"]
+        item["frequency"] = frequency["frequency"]
+        item["modifier"] = frequency["modifier"]
+        item["n"] = frequency["n"]
+
+        item["pmt_source_desc"] = code_desc(lookups, "pmt-source", item["pmt_source"])
+        item["pmt_method_desc"] = code_desc(lookups, "pmt-method", item["pmt_method"])
+        resolved.append(item)
+
+    return resolved
+
+
+def code_desc(lookups, cd_group, cd):
+    # description of code cd if it belongs to cd_group
+    code = lookups.lookup("codes_by_cd", cd)
+    if code is None or code["cd_group"] != cd_group:
+        return None
+    return code["cd_desc"]
 
 
 # Format schedule is run separate from get_scheduled for usage in page display
@@ -86,27 +149,45 @@ def format_schedule(schedule):
         item["amount"] = usd(item["amount"] * item["factor"])
 
         # format date
-        item["dt"] = format_date(str(item["dt"]))
+        item["dt"] = format_date(item["dt"])
+
+        # frequency label
+        item["frequency_display"] = format_frequency(item["frequency"], item["repeat"], item["n"], item["modifier"])
+
+
+@lru_cache(maxsize=256)
+def format_frequency(frequency, repeat, n, modifier):
+    """Formats frequency label, memoized per (frequency, repeat, n, modifier)."""
+    # standard 1 repeat or One Time display actual frequency
+    if repeat == 1 or frequency == "One Time":
+        return frequency
+
+    # modifier for weekly date updates is days but display will show weeks
+    elif frequency == "Weekly":
+        return "Every " + str(repeat) + " Weeks"
 
-        # standard 1 repeat or One Time display actual frequency
-        if item["repeat"] == 1 or item["frequency"] == "One Time":
-            item["frequency_display"] = item["frequency"]
+    # else "Every n modifier"
+    else:
+        return "Every " + str(n * repeat) + " " + modifier
+
+
+def frequency_display(item):
+    """Formats item's frequency label, for use as a Jinja filter."""
+    return format_frequency(item["frequency"], item["repeat"], item["n"], item["modifier"])
 
-        # modifier for weekly date updates is days but display will show weeks
-        elif item["frequency"] == "Weekly":
-            item["frequency_display"] = "Every " + str(item["repeat"]) + " Weeks"
 
-        # else "Every n modifier"
-        else:
-            item["frequency_display"] = "Every " + str(item["n"] * item["repeat"]) + " " + item["modifier"]
+# query for a user's balances
+BALANCES_QUERY = "SELECT user_id, current, available \
+                 FROM balance \
+                 WHERE user_id = :user_id;"
 
 
 def get_balances(db, user_id):
     # query database for balances
-    balance = db.execute("SELECT user_id, current, available \
-                         FROM balance \
-                         WHERE user_id = :user_id;", user_id=user_id)
+    return resolve_balances(db.execute(BALANCES_QUERY, user_id=user_id))
 
+
+def resolve_balances(balance):
      # create dictionary for balances
     balances = {}
 
@@ -119,9 +200,10 @@ def get_balances(db, user_id):
     # pending transactions if any
     balances["pending"] = balances["current"] - balances["available"]
 
-    # query database for scheduled
-    scheduled = get_scheduled(db, user_id)
+    return balances
+
 
+def net_balances(balances, scheduled):
     # scheduled available balance
     # amount is converted by factor payments/bills are negative and deposits are positive
     balances["net"] = balances["available"] + sum(item['amount'] * item['factor'] for item in scheduled if item['pmt_source'] == 'CHK' and item['schedule_type'] == 'Current')
@@ -129,29 +211,95 @@ def get_balances(db, user_id):
     # next scheduled available balance
     balances["next_net"] = balances["net"] + sum(item['amount'] * item['factor'] for item in scheduled if item['pmt_source'] == 'CHK' and item['schedule_type'] == 'Next')
 
-    #print(balances)
-    return balances
 
+def get_dashboard(db, user_id, lookups):
+    """
+    Loads balances and scheduled items for user_id, running the scheduled query once.
 
-def format_balances(balances):
-    # convert all balances to usd for display on page
-    for k, _ in balances.items():
-        balances[k] = usd(balances[k])
+    Results come from the user's snapshot when it is current, and are kept on flask.g, so routes
+    (and helpers) needing both within a request share them. With DASHBOARD_CACHE_VERIFY, snapshots
+    are checked against the user's change counter, so writes in other processes are seen too.
+    The format_* helpers modify them in place, so format only once everything is computed.
+    """
+    dashboard = _request_dashboard(user_id)
+    if dashboard is None:
+        # current snapshot, if any
+        version = get_version(db, user_id) if current_app.config.get("DASHBOARD_CACHE_VERIFY") else None
+        dashboard = _snapshot_dashboard(user_id, version)
 
+        if dashboard is None:
+            # query database for balances and scheduled
+            dashboard = _keep_dashboard(user_id, version, get_balances(db, user_id), get_scheduled(db, user_id, lookups))
 
-def format_modifier(item):
+    return dashboard
 
-    try:
-        # set n for date modifier
-        n = item["repeat"] * item["n"]
 
-        # create modifier string for date function
-        modifier = str(n) + " " + item["modifier"]
+async def get_dashboard_async(adb, user_id, lookups, version=None):
+    """
+    Awaitable get_dashboard through AsyncSQL adb, running the balances and scheduled queries concurrently.
+    Pass the user's version if already known (e.g. for an ETag), else it is queried when snapshots are verified.
+    """
+    dashboard = _request_dashboard(user_id)
+    if dashboard is None:
+        if version is None and current_app.config.get("DASHBOARD_CACHE_VERIFY"):
+            version = await get_version_async(adb, user_id)
+        dashboard = _snapshot_dashboard(user_id, version)
+
+        if dashboard is None:
+            # both queries at once, each on its own connection
+            import asyncio
+            balance, scheduled = await asyncio.gather(adb.execute(BALANCES_QUERY, user_id=user_id),
+                                                      adb.execute(scheduled_query(adb.dialect), user_id=user_id))
+            # resolving may reload lookups through the blocking SQL, so off the event loop
+            scheduled = await asyncio.to_thread(resolve_scheduled, scheduled, lookups)
+            dashboard = _keep_dashboard(user_id, version, resolve_balances(balance), scheduled)
+
+    return dashboard
+
+
+def _request_dashboard(user_id):
+    # user's (balances, scheduled) if already loaded during this request, else None
+    dashboard = g.get("dashboard")
+    if dashboard is None or dashboard[0] != user_id:
+        return None
+    return dashboard[1], dashboard[2]
+
+
+def _snapshot_dashboard(user_id, version):
+    # user's (balances, scheduled) from a snapshot current at version, kept for the request, else None
+    snapshot = snapshots.get(user_id, version)
+    if snapshot is None:
+        return None
+    balances, scheduled = snapshot
+    g.dashboard = (user_id, balances, scheduled)
+    return balances, scheduled
+
 
-        return modifier
+def _keep_dashboard(user_id, version, balances, scheduled):
+    # derive net and next_net from the same freshly queried scheduled rows, then snapshot and keep for the request
+    net_balances(balances, scheduled)
+    snapshots.put(user_id, version, balances, scheduled)
+    g.dashboard = (user_id, balances, scheduled)
+    return balances, scheduled
 
-    except:
-        raise RuntimeError("unable to format date modifier")
+
+def invalidate_dashboard(user_id):
+    # drop user's snapshot (and this request's copy) after a committed write
+    snapshots.invalidate(user_id)
+    g.pop("dashboard", None)
+
+
+def get_forecast(db, user_id, lookups, days):
+    # project checking balance from available over the next days days (numpy is only imported once needed)
+    from forecast import project
+    balances, scheduled = get_dashboard(db, user_id, lookups)
+    return project(balances["available"], scheduled, date.today(), days)
+
+
+def format_balances(balances):
+    # convert all balances to usd for display on page
+    for k, _ in balances.items():
+        balances[k] = usd(balances[k])
 
 
 def get_types(db):
@@ -182,6 +330,14 @@ def get_codes(db):
 
 
 def insert_schedule(db, user_id, data):
+    # insert into schedule and count the change in one transaction
+    with db.transaction():
+        insert_item(db, user_id, data)
+        bump_version(db, user_id)
+    invalidate_dashboard(user_id)
+
+
+def insert_item(db, user_id, data):
     # insert into schedule
     db.execute("INSERT INTO schedule (name, type_id, current_dt, frequency_id, repeat, amount, user_id, pmt_source, pmt_method)\
                VALUES(:name, :type_id, :current_dt, :frequency_id, :repeat, :amount, :user_id, :pmt_source, :pmt_method);",\
@@ -190,66 +346,376 @@ def insert_schedule(db, user_id, data):
                pmt_source=data["pmt_source"], pmt_method=data["pmt_method"])
 
 
-def complete_item(db, schedule_id):
+class ImportRejected(Exception):
+    """Raised inside an import's transaction to roll it back."""
+
+
+def import_csv(db, user_id, lookups, lines, batch_size=1000, max_errors=100):
+    """
+    Imports scheduled items, or balances, for user_id from CSV lines (any iterable of strings, read lazily).
+
+    Schedule files have columns name, type, pmt_source, pmt_method, current_dt, frequency, repeat and amount;
+    type, frequency and codes may be given by id (code) or label. Balance files have columns current and available.
+    Rows are validated against the cached lookups and inserted batch_size at a time in one transaction, so memory
+    stays constant; if any row is invalid nothing is imported. Returns (rows imported, [(line, error), ...]),
+    reporting at most max_errors errors.
+    """
+    reader = csv.DictReader(lines)
+    columns = [column.strip().lower() for column in reader.fieldnames or []]
+    reader.fieldnames = columns
+
+    # balance file updates the balance row
+    if "current" in columns:
+        return import_balances(db, user_id, reader)
+
+    missing = [column for column in ["name", "type", "pmt_source", "pmt_method", "current_dt", "frequency", "amount"] if column not in columns]
+    if missing:
+        return 0, [(1, "missing columns: {}".format(", ".join(missing)))]
+
+    # accepted ids and labels, resolved once
+    types = resolver(lookups.types, "type_id", "label")
+    frequencies = resolver(lookups.frequencies, "frequency_id", "frequency")
+    sources = resolver([code for code in lookups.codes if code["cd_group"] == "pmt-source"], "cd", "cd_desc")
+    methods = resolver([code for code in lookups.codes if code["cd_group"] == "pmt-method"], "cd", "cd_desc")
+
+    imported = 0
+    errors = []
+    batch = []
+    try:
+        with db.transaction():
+            for row in reader:
+                try:
+                    batch.append(parse_item(row, user_id, types, frequencies, sources, methods))
+                except ValueError as e:
+                    if len(errors) < max_errors:
+                        errors.append((reader.line_num, str(e)))
+                    continue
+
+                # insert full batches while reading, unless already failing
+                if len(batch) >= batch_size:
+                    if not errors:
+                        insert_items(db, batch)
+                    imported += len(batch)
+                    batch = []
+
+            # any invalid row rolls back the whole import
+            if errors:
+                raise ImportRejected()
+            if batch:
+                insert_items(db, batch)
+                imported += len(batch)
+            bump_version(db, user_id)
+
+    except ImportRejected:
+        return 0, errors
+
+    invalidate_dashboard(user_id)
+    return imported, errors
+
+
+def import_balances(db, user_id, reader):
+    # first row holds current and (optionally) available balances
+    row = next(reader, None)
+    try:
+        current = float(row["current"])
+        available = float(row.get("available") or row["current"])
+    except (TypeError, ValueError):
+        return 0, [(2, "current and available must be amounts")]
+    if not (math.isfinite(current) and math.isfinite(available)):
+        return 0, [(2, "current and available must be amounts")]
+
+    # update balances and count the change
+    db.execute("UPDATE balance \
+               SET current = :current \
+               ,available = :available \
+               ,version = version + 1 \
+               WHERE user_id = :user_id;", current=current, available=available, user_id=user_id)
+    invalidate_dashboard(user_id)
+    return 1, []
+
+
+def resolver(rows, key, label):
+    # map of accepted spellings (id or case-insensitive label) to id
+    values = {}
+    for row in rows:
+        values[str(row[key]).lower()] = row[key]
+        values[str(row[label]).lower()] = row[key]
+    return values
+
+
+def parse_item(row, user_id, types, frequencies, sources, methods):
+    # validated schedule insert parameters from a CSV row, raising ValueError with the reason
+    def lookup(values, column):
+        value = (row.get(column) or "").strip().lower()
+        if value not in values:
+            raise ValueError("unknown {}: {}".format(column, row.get(column)))
+        return values[value]
+
+    name = (row.get("name") or "").strip()
+    if not name:
+        raise ValueError("name is required")
+
+    try:
+        current_dt = datetime.strptime((row.get("current_dt") or "").strip(), "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError("current_dt must be YYYY-MM-DD: {}".format(row.get("current_dt")))
+
+    try:
+        repeat = int(row.get("repeat") or 1)
+        amount = float(row.get("amount"))
+    except (TypeError, ValueError):
+        raise ValueError("repeat must be a whole number and amount an amount")
+    if not math.isfinite(amount):
+        raise ValueError("repeat must be a whole number and amount an amount")
+    if repeat < 1 or amount < 0:
+        raise ValueError("repeat must be at least 1 and amount not negative")
+
+    return {"name": name, "type_id": lookup(types, "type"), "current_dt": current_dt.isoformat(),
+            "frequency_id": lookup(frequencies, "frequency"), "repeat": repeat, "amount": amount, "user_id": user_id,
+            "pmt_source": lookup(sources, "pmt_source"), "pmt_method": lookup(methods, "pmt_method")}
+
+
+def insert_items(db, items):
+    # insert parsed schedule items as one batch
+    db.executemany("INSERT INTO schedule (name, type_id, current_dt, frequency_id, repeat, amount, user_id, pmt_source, pmt_method)\
+                   VALUES(:name, :type_id, :current_dt, :frequency_id, :repeat, :amount, :user_id, :pmt_source, :pmt_method);", items)
+
+
+def export_schedule(db, user_id=None):
+    # stream user's (or, for None, every user's) scheduled items including completed ones, with history dates
+    selection = "WHERE S.user_id = :user_id " if user_id is not None else ""
+    return db.iterate("SELECT S.schedule_id, S.user_id, S.name, T.label AS type, F.frequency, S.repeat, S.amount, T.factor, \
+                      S.pmt_source, S.pmt_method, S.current_dt, S.snoozed_dt, S.previous_dt, S.completed_dt \
+                      FROM schedule S \
+                      LEFT JOIN type T ON S.type_id = T.type_id \
+                      LEFT JOIN frequency F ON S.frequency_id = F.frequency_id " + selection +
+                      "ORDER BY S.user_id, S.schedule_id;", **({"user_id": user_id} if user_id is not None else {}))
+
+
+def write_csv(records, chunk_size=65536):
+    """Yields CSV text for records (header from the first record's fields), in chunks of about chunk_size characters."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for i, record in enumerate(records):
+        if i == 0:
+            writer.writerow(record._fields)
+        writer.writerow(record)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def write_ndjson(records, chunk_size=65536):
+    """Yields newline-delimited JSON for records, one object per line, in chunks of about chunk_size characters."""
+    lines = []
+    size = 0
+    for record in records:
+        line = json.dumps(record._asdict(), default=str) + "\n"
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield "".join(lines)
+
+
+def complete_items(db, user_id, schedule_ids):
+    # complete the user's open schedule_ids, ledgering their current occurrence, as one set-based statement
+    if not schedule_ids:
+        return 0
+    selection = "AND schedule.schedule_id IN :schedule_ids"
+
     # update completed_dt and reset snoozed_dt
-    db.execute("UPDATE schedule \
-               SET completed_dt = date('now') \
-               ,snoozed_dt = NULL \
-               WHERE schedule_id = :schedule_id;", schedule_id=schedule_id)
+    with db.transaction():
+        lock_items(db, user_id, selection, schedule_ids=list(schedule_ids))
+        record_postings(db, user_id, selection, schedule_ids=list(schedule_ids))
+        completed = db.execute("UPDATE schedule \
+                               SET completed_dt = CURRENT_DATE \
+                               ,snoozed_dt = NULL \
+                               WHERE schedule.user_id = :user_id \
+                               AND schedule.completed_dt is NULL " + selection + ";", user_id=user_id,
+                               schedule_ids=list(schedule_ids))
+        bump_version(db, user_id)
+    invalidate_dashboard(user_id)
+
+    return completed
+
+
+def post_items(db, user_id, schedule_ids=None, due_before=None):
+    # post the user's open schedule_ids, or all items due before due_before, as one set-based statement
+    if schedule_ids is not None:
+        if not schedule_ids:
+            return 0
+        selection = "AND schedule.schedule_id IN :schedule_ids"
+        params = {"schedule_ids": list(schedule_ids)}
+    else:
+        selection = "AND coalesce(schedule.snoozed_dt, schedule.current_dt) < :due_before"
+        params = {"due_before": due_before}
+
+    # One Time items are completed, all others move current_dt forward by repeat * n modifier
+    # (only items with a frequency are posted, so only those are ledgered)
+    with db.transaction():
+        lock_items(db, user_id, selection, **params)
+        record_postings(db, user_id, selection, joins="INNER JOIN frequency F ON schedule.frequency_id = F.frequency_id",
+                        **params)
+        posted = db.execute("UPDATE schedule \
+                            SET completed_dt = CASE WHEN F.frequency = 'One Time' THEN CURRENT_DATE ELSE completed_dt END \
+                            ,previous_dt = CASE WHEN F.frequency = 'One Time' THEN previous_dt ELSE current_dt END \
+                            ,current_dt = CASE WHEN F.frequency = 'One Time' THEN current_dt \
+                            ELSE " + db.dialect.advance("current_dt", "schedule.repeat * F.n", "F.modifier") + " END \
+                            ,snoozed_dt = NULL \
+                            FROM frequency F \
+                            WHERE schedule.frequency_id = F.frequency_id \
+                            AND schedule.user_id = :user_id \
+                            AND schedule.completed_dt is NULL " + selection + ";", user_id=user_id, **params)
+        bump_version(db, user_id)
+    invalidate_dashboard(user_id)
+
+    return posted
+
+
+def lock_items(db, user_id, selection, **params):
+    # lock the user's open items matching selection until the transaction ends, so a concurrent Post or Complete
+    # of the same items waits and then sees them already moved on, rather than ledgering them a second time
+    select = db.dialect.lock_rows("SELECT schedule.schedule_id \
+                                  FROM schedule \
+                                  WHERE schedule.user_id = :user_id \
+                                  AND schedule.completed_dt is NULL " + selection)
+    if select is not None:
+        db.execute(select + ";", user_id=user_id, **params)
+
+
+def record_postings(db, user_id, selection, joins="", **params):
+    # append the user's open items matching selection (and joins) to the posting ledger at their due date,
+    # call after lock_items and before posting them
+    db.execute("INSERT INTO posting (schedule_id, user_id, posted_dt, amount, factor, pmt_source) \
+               SELECT schedule.schedule_id, schedule.user_id, coalesce(schedule.snoozed_dt, schedule.current_dt) \
+               ,schedule.amount, T.factor, schedule.pmt_source \
+               FROM schedule \
+               INNER JOIN type T ON schedule.type_id = T.type_id " + joins + " \
+               WHERE schedule.user_id = :user_id \
+               AND schedule.completed_dt is NULL " + selection + ";", user_id=user_id, **params)
+
+
+def get_postings(db, user_id, before=None, limit=50):
+    """
+    Returns up to limit of user_id's postings, newest first, and the (posted_dt, posting_id) key to pass as
+    before for the next page (None on the last page). Paging by key rather than OFFSET keeps every page an
+    index range scan however long the ledger grows.
+    """
+    selection = ""
+    params = {}
+    if before is not None:
+        selection = "AND (P.posted_dt, P.posting_id) < (:posted_dt, :posting_id) "
+        params = {"posted_dt": before[0], "posting_id": before[1]}
+
+    # one extra row tells whether there is an older page
+    rows = db.execute("SELECT P.posting_id, P.posted_dt, S.name, P.amount * P.factor AS amount, P.pmt_source \
+                      FROM posting P \
+                      INNER JOIN schedule S ON P.schedule_id = S.schedule_id \
+                      WHERE P.user_id = :user_id " + selection + "\
+                      ORDER BY P.posted_dt DESC, P.posting_id DESC \
+                      LIMIT :limit;", user_id=user_id, limit=limit + 1, **params)
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (str(rows[-1]["posted_dt"]), rows[-1]["posting_id"])
+    return rows, None
 
 
 def snooze_item(db, data):
-    # update snoozed_dt
-    db.execute("UPDATE schedule \
-               SET snoozed_dt = :snoozed \
-               WHERE schedule_id = :schedule_id;",snoozed=data["snoozed"], schedule_id=data["schedule_id"])
+    # update snoozed_dt and count the change in one transaction
+    with db.transaction():
+        db.execute("UPDATE schedule \
+                   SET snoozed_dt = :snoozed \
+                   WHERE schedule_id = :schedule_id;",snoozed=data["snoozed"], schedule_id=data["schedule_id"])
+        bump_version(db, data["user_id"])
+    invalidate_dashboard(data["user_id"])
 
 
 def update_schedule(db, data):
-    # logic for post action
+    # post and complete are set-based commands of their own
     if data["action"] == "Post":
-        # get schedule item
-        item = get_item(db, data["schedule_id"])
-
-        # set completed_dt for One Time
-        if item['frequency'] == "One Time":
-                complete_item(db, data["schedule_id"])
-
-        # all others move current_dt forward
-        else:
-            # format date modifier string
-            modifier = format_modifier(item)
-
-            # set new current_dt
-            db.execute("UPDATE schedule \
-                       SET current_dt = current_dt + :modifier ::INTERVAL \
-                       ,snoozed_dt = NULL \
-                       ,previous_dt = current_dt \
-                       WHERE schedule_id = :schedule_id;", schedule_id=data["schedule_id"], modifier=modifier)
-
-    # complete action
-    elif data["action"] == "Complete":
-        complete_item(db, data["schedule_id"])
-
-    # edit action
-    elif data["action"] == "Edit":
-            # update all fields from form
-            db.execute("UPDATE schedule \
-                       SET name = :name \
-                       ,type_id = :type_id \
-                       ,current_dt = :current_dt \
-                       ,snoozed_dt = NULL \
-                       ,frequency_id = :frequency_id \
-                       ,repeat = :repeat \
-                       ,amount = :amount \
-                       ,pmt_source = :pmt_source\
-                       ,pmt_method = :pmt_method\
-                       WHERE schedule_id = :schedule_id;", schedule_id=data["schedule_id"], name=data["name"], type_id=data["type_id"],
-                       current_dt=data["current_dt"], frequency_id=data["frequency_id"],
-                       repeat=data["repeat"], amount=data["amount"], 
-                       pmt_source=data["pmt_source"], pmt_method=data["pmt_method"])
+        return post_items(db, data["user_id"], schedule_ids=[data["schedule_id"]])
+    if data["action"] == "Complete":
+        return complete_items(db, data["user_id"], [data["schedule_id"]])
+
+    # update and count the change in one transaction
+    with db.transaction():
+        # edit action
+        if data["action"] == "Edit":
+                # update all fields from form
+                db.execute("UPDATE schedule \
+                           SET name = :name \
+                           ,type_id = :type_id \
+                           ,current_dt = :current_dt \
+                           ,snoozed_dt = NULL \
+                           ,frequency_id = :frequency_id \
+                           ,repeat = :repeat \
+                           ,amount = :amount \
+                           ,pmt_source = :pmt_source\
+                           ,pmt_method = :pmt_method\
+                           WHERE schedule_id = :schedule_id;", schedule_id=data["schedule_id"], name=data["name"], type_id=data["type_id"],
+                           current_dt=data["current_dt"], frequency_id=data["frequency_id"],
+                           repeat=data["repeat"], amount=data["amount"], 
+                           pmt_source=data["pmt_source"], pmt_method=data["pmt_method"])
+
+        bump_version(db, data["user_id"])
+    invalidate_dashboard(data["user_id"])
+
+
+def bump_version(db, user_id):
+    # count a change to user's balances or schedule, so cached views of them (e.g. ETags) go stale
+    db.execute("UPDATE balance \
+               SET version = version + 1 \
+               WHERE user_id = :user_id;", user_id=user_id)
+
+
+# query for a user's change counter
+VERSION_QUERY = "SELECT version \
+                FROM balance \
+                WHERE user_id = :user_id;"
+
+
+def get_version(db, user_id):
+    # query database for user's change counter
+    version = db.execute(VERSION_QUERY, user_id=user_id)
+
+    return version[0]["version"] if version else None
 
 
+async def get_version_async(adb, user_id):
+    # query database for user's change counter through AsyncSQL
+    version = await adb.execute(VERSION_QUERY, user_id=user_id)
+
+    return version[0]["version"] if version else None
+
+
+def dashboard_etag(user_id, version):
+    """
+    ETag of user's dashboard data at version (as get_version returns it, None for a user without balances):
+    changes with every write and at midnight, when schedule buckets roll over.
+    """
+    return "{}-{}-{}".format(user_id, version, date.today().isoformat())
+
+
+async def etag_response_async(etag, build):
+    """Returns 304 if the request already has etag, else jsonify(await build()); build only runs when needed."""
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(await build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@lru_cache(maxsize=4096)
 def usd(value):
     """Formats value as USD."""
     if value < 0:
@@ -258,8 +724,9 @@ def usd(value):
         return f"${value:,.2f}"
 
 
+@lru_cache(maxsize=4096)
 def format_date(date):
-    """Formats date as m/d/yyyy."""
-    d = datetime.strptime(date, '%Y-%m-%d')
-    return d.strftime("%m/%d/%Y")
-
+    """Formats date (a date, or a YYYY-MM-DD string as SQLite returns) as mm/dd/yyyy."""
+    if isinstance(date, str):
+        date = datetime.strptime(date, '%Y-%m-%d')
+    return "{:02d}/{:02d}/{:04d}".format(date.month, date.day, date.year)
@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS sessions;
+DROP TABLE IF EXISTS posting;
 DROP TABLE IF EXISTS schedule;
 DROP TABLE IF EXISTS balance;
 DROP TABLE IF EXISTS frequency;
@@ -42,13 +44,14 @@ INSERT INTO cd (cd, cd_group, cd_desc) VALUES ('DD', 'pmt-method', 'Direct Depos
 
 CREATE TABLE users
 (user_id SERIAL PRIMARY KEY NOT NULL
-, username TEXT
+, username TEXT UNIQUE
 , hash TEXT);
 
 CREATE TABLE balance
 (user_id INTEGER PRIMARY KEY NOT NULL
 , current NUMERIC NOT NULL DEFAULT 0 
 , available NUMERIC NOT NULL DEFAULT 0 
+, version INTEGER NOT NULL DEFAULT 0
 , CONSTRAINT fk_balance_user FOREIGN KEY(user_id) REFERENCES users(user_id));
 
 CREATE TABLE schedule
@@ -67,4 +70,30 @@ CREATE TABLE schedule
 , pmt_method TEXT
 , CONSTRAINT fk_schedule_user FOREIGN KEY(user_id) REFERENCES users(user_id)
 , CONSTRAINT fk_schedule_type FOREIGN KEY(type_id) REFERENCES type(type_id)
-, CONSTRAINT fk_schedule_frequency FOREIGN KEY(frequency_id) REFERENCES frequency(frequency_id));
\ No newline at end of file
+, CONSTRAINT fk_schedule_frequency FOREIGN KEY(frequency_id) REFERENCES frequency(frequency_id));
+
+-- dashboard queries filter one user's open items and paychecks
+CREATE INDEX ix_schedule_user_completed ON schedule (user_id, completed_dt);
+CREATE INDEX ix_schedule_user_type ON schedule (user_id, type_id);
+
+CREATE TABLE sessions
+(session_id TEXT PRIMARY KEY NOT NULL
+, data TEXT NOT NULL
+, expires_dt TIMESTAMP NOT NULL);
+
+-- expired sessions are deleted in bulk
+CREATE INDEX ix_sessions_expires ON sessions (expires_dt);
+
+CREATE TABLE posting
+(posting_id SERIAL PRIMARY KEY NOT NULL
+, schedule_id INTEGER NOT NULL
+, user_id INTEGER NOT NULL
+, posted_dt DATE NOT NULL
+, amount NUMERIC
+, factor INTEGER
+, pmt_source TEXT
+, CONSTRAINT fk_posting_schedule FOREIGN KEY(schedule_id) REFERENCES schedule(schedule_id)
+, CONSTRAINT fk_posting_user FOREIGN KEY(user_id) REFERENCES users(user_id));
+
+-- history pages through one user's postings newest first by (posted_dt, posting_id)
+CREATE INDEX ix_posting_user_posted ON posting (user_id, posted_dt, posting_id);
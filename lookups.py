@@ -0,0 +1,101 @@
+import threading
+import time
+
+from helpers import get_codes, get_frequencies, get_types
+
+
+class LookupCache(object):
+    """Keep the type, frequency and cd lookup tables in process memory."""
+
+    def __init__(self, db, ttl=None):
+        """
+        Cache lookups read through db.
+        If ttl is a number of seconds, tables are reloaded once they are older than that;
+        otherwise they are kept until invalidate is called.
+        """
+        self.db = db
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tables = None
+        self._loaded = None
+        self._misses = set()
+
+    def load(self):
+        """(Re)loads all lookup tables from the database."""
+
+        # query database for lookups
+        types = get_types(self.db)
+        frequencies = get_frequencies(self.db)
+        codes = get_codes(self.db)
+
+        # lists for forms plus dict-by-id views for resolving labels without joins
+        tables = {
+            "types": types,
+            "frequencies": frequencies,
+            "codes": codes,
+            "types_by_id": {item["type_id"]: item for item in types},
+            "frequencies_by_id": {item["frequency_id"]: item for item in frequencies},
+            "codes_by_cd": {item["cd"]: item for item in codes},
+        }
+
+        # swap in all tables at once so readers never see a partial load
+        with self._lock:
+            self._tables = tables
+            self._loaded = time.monotonic()
+        return tables
+
+    def invalidate(self):
+        """Drops cached tables and known misses, so the next read reloads them."""
+        with self._lock:
+            self._tables = None
+            self._misses = set()
+
+    def preload(self):
+        """Loads tables now if missing or expired, e.g. ahead of a block whose statements are counted."""
+        self._get("types")
+
+    def _get(self, name):
+        """Returns cached table name, loading tables if missing or expired."""
+        tables = self._tables
+        if tables is None or (self.ttl is not None and time.monotonic() - self._loaded > self.ttl):
+            # misses are only forgotten with the tables they were missing from, not on a miss's own reload
+            with self._lock:
+                self._misses = set()
+            tables = self.load()
+        return tables[name]
+
+    def lookup(self, name, key):
+        """Returns row key of dict view name, reloading once if key is unknown (e.g. a row added since load)."""
+        if key is None:
+            return None
+        row = self._get(name).get(key)
+        if row is None and (name, key) not in self._misses:
+            self.load()
+            row = self._get(name).get(key)
+            if row is None:
+                self._misses.add((name, key))
+        return row
+
+    @property
+    def types(self):
+        return self._get("types")
+
+    @property
+    def frequencies(self):
+        return self._get("frequencies")
+
+    @property
+    def codes(self):
+        return self._get("codes")
+
+    @property
+    def types_by_id(self):
+        return self._get("types_by_id")
+
+    @property
+    def frequencies_by_id(self):
+        return self._get("frequencies_by_id")
+
+    @property
+    def codes_by_cd(self):
+        return self._get("codes_by_cd")
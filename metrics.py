@@ -0,0 +1,162 @@
+import bisect
+import contextvars
+import hashlib
+import re
+import threading
+
+
+class Histogram(object):
+    """Count observations (in seconds) into cumulative buckets, Prometheus-style."""
+
+    # upper bounds in seconds, from 1 ms to 10 s
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Records one observation."""
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def snapshot(self):
+        """Returns count, sum and cumulative bucket counts (le bound -> count) as a dict."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = {}
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            running += count
+            cumulative["+Inf" if bound == float("inf") else repr(bound)] = running
+        return {"count": running, "sum": total, "buckets": cumulative}
+
+
+class Counter(object):
+    """Count a running total, Prometheus-style."""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Adds amount."""
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        """Returns the total."""
+        return self._value
+
+
+class Registry(object):
+    """Named, labelled histograms and counters, rendered in Prometheus text format."""
+
+    def __init__(self):
+        # name -> (type, help, {labels: metric})
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, **labels):
+        """Returns the histogram name with labels, creating it on first use."""
+        return self._get(name, "histogram", help, labels, Histogram)
+
+    def counter(self, name, help, **labels):
+        """Returns the counter name with labels, creating it on first use."""
+        return self._get(name, "counter", help, labels, Counter)
+
+    def info(self, name, help, **labels):
+        """Records a constant 1 with labels, e.g. to map a fingerprint to its statement."""
+        self._get(name, "gauge", help, labels, lambda: 1)
+
+    def register(self, name, help, metric, **labels):
+        """Adds an existing Histogram or Counter (e.g. a pool's) under name with labels."""
+        kind = "histogram" if isinstance(metric, Histogram) else "counter"
+        self._get(name, kind, help, labels, lambda: metric)
+
+    def _get(self, name, kind, help, labels, create):
+        key = tuple(sorted(labels.items()))
+        family = self._families.get(name)
+        if family is not None and key in family[2]:
+            return family[2][key]
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help, {}))
+            return family[2].setdefault(key, create())
+
+    def render(self):
+        """Returns every metric in Prometheus text exposition format."""
+        with self._lock:
+            families = [(name, kind, help, list(metrics.items())) for name, (kind, help, metrics) in sorted(self._families.items())]
+
+        lines = []
+        for name, kind, help, metrics in families:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, metric in metrics:
+                if kind == "histogram":
+                    snapshot = metric.snapshot()
+                    for bound, count in snapshot["buckets"].items():
+                        lines.append("{}_bucket{} {}".format(name, _labels(labels + (("le", bound),)), count))
+                    lines.append("{}_sum{} {}".format(name, _labels(labels), snapshot["sum"]))
+                    lines.append("{}_count{} {}".format(name, _labels(labels), snapshot["count"]))
+                elif kind == "counter":
+                    lines.append("{}{} {}".format(name, _labels(labels), metric.value()))
+                else:
+                    lines.append("{}{} {}".format(name, _labels(labels), metric))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    """Formats label pairs as {name="value",...}, escaping values."""
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join('{}="{}"'.format(name, value) for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def fingerprint(text):
+    """
+    Returns (digest, normalized) for a SQL statement: whitespace collapsed and literals replaced by ?,
+    so the same statement groups together however it is written. Parameters (:name) are kept.
+    """
+    normalized = " ".join(text.split())
+    normalized = re.sub(r"'(?:[^']|'')*'", "?", normalized)
+    normalized = re.sub(r"(?<![\w:])\d+(?:\.\d+)?\b", "?", normalized)
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+# per-request breakdown of time by component (e.g. db, render), when one is being collected
+_timings = contextvars.ContextVar("timings", default=None)
+
+
+def start_timings():
+    """Starts collecting the current request's breakdown, returning it as {name: [seconds, count]}."""
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+def add_timing(name, elapsed):
+    """Adds elapsed seconds under name to the current request's breakdown, if one is being collected."""
+    timings = _timings.get()
+    if timings is not None:
+        timing = timings.setdefault(name, [0.0, 0])
+        timing[0] += elapsed
+        timing[1] += 1
+
+
+def server_timing(timings, total):
+    """Formats a breakdown and the request's total seconds as a Server-Timing header value."""
+    metrics = ['{};dur={:.1f};desc="{} calls"'.format(name, seconds * 1000, count)
+               for name, (seconds, count) in sorted(timings.items())]
+    metrics.append("total;dur={:.1f}".format(total * 1000))
+    return ", ".join(metrics)
+
+
+# shared by the app and its SQL instance
+registry = Registry()
@@ -0,0 +1,122 @@
+import os
+import threading
+import warnings
+
+
+# sha512_crypt rounds passlib's custom_app_context used for existing hashes
+DEFAULT_ROUNDS = 656000
+
+
+class PasswordsBusy(RuntimeError):
+    """Raised when the hashing queue is full, so the request can be turned away quickly."""
+
+
+class Passwords(object):
+    """Hash and verify passwords in a bounded pool of worker processes, off the request thread."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, workers=1, queue=None, timeout=30):
+        """
+        Hashes use sha512_crypt with rounds rounds; hashes at any other cost (or sha256_crypt) are replaced on login.
+        At most workers hashes run at once with up to queue more waiting (default 4 per worker), beyond which
+        PasswordsBusy is raised. workers=0 hashes on the calling thread.
+        """
+        self.rounds = rounds
+        self.workers = workers
+        self.queue = 4 * workers if queue is None else queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(workers + self.queue, 1))
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def hash(self, secret):
+        """Returns a new hash of secret."""
+        return self._call(_hash, secret)
+
+    def verify_and_update(self, secret, hash):
+        """Returns (valid, new_hash), new_hash being a replacement at the current cost or None if hash is current."""
+        return self._call(_verify_and_update, secret, hash)
+
+    def _call(self, fn, *args):
+        if not self.workers:
+            _configure(self.rounds)
+            return fn(*args)
+
+        from concurrent.futures import TimeoutError
+        from concurrent.futures.process import BrokenProcessPool
+
+        # fail fast rather than queue behind a burst
+        if not self._slots.acquire(blocking=False):
+            raise PasswordsBusy("too many password hashes in progress")
+        executor = self._pool()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard(executor)
+            raise PasswordsBusy("password workers stopped, restarting them")
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        # a hash that is stuck or whose worker died turns the request away like a full queue
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordsBusy("password hash timed out")
+        except BrokenProcessPool:
+            self._discard(executor)
+            raise PasswordsBusy("password workers stopped, restarting them")
+
+    def _pool(self):
+        # started on first use in each process, so workers of each gunicorn worker are its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # started from a clean server process rather than forked from this multi-threaded one
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method),
+                                                     initializer=_configure, initargs=(self.rounds,))
+                self._pid = os.getpid()
+            return self._executor
+
+    def _discard(self, executor):
+        # drop a broken pool, so the next hash starts a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+
+def context(rounds=DEFAULT_ROUNDS):
+    """Returns a CryptContext hashing at rounds, flagging any other cost or scheme for update."""
+    # imported on first use, by which time SQL may have turned warnings (passlib's crypt deprecation) into errors
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        from passlib.context import CryptContext
+    return CryptContext(schemes=["sha512_crypt", "sha256_crypt"],
+                        deprecated=["sha256_crypt"],
+                        sha512_crypt__default_rounds=rounds,
+                        sha512_crypt__min_rounds=rounds,
+                        sha512_crypt__max_rounds=rounds)
+
+
+# context of the process doing the hashing
+_context = None
+
+
+def _configure(rounds):
+    global _context
+    if _context is None or _context.to_dict().get("sha512_crypt__default_rounds") != rounds:
+        _context = context(rounds)
+
+
+def _hash(secret):
+    return _context.hash(secret)
+
+
+def _verify_and_update(secret, hash):
+    return _context.verify_and_update(secret, hash)
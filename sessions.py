@@ -0,0 +1,106 @@
+import secrets
+import time
+from datetime import datetime, timezone
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class DatabaseSession(CallbackDict, SessionMixin):
+    """Session whose data lives in the sessions table, keyed by a random id in the cookie."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.cleared = False
+        # user the stored session belongs to, so a login or logout can be given a fresh id
+        self.user_id = self.get("user_id")
+
+    def clear(self):
+        self.cleared = True
+        super().clear()
+
+
+class DatabaseSessionInterface(SessionInterface):
+    """Store sessions in the sessions table through the SQL wrapper, shared by all workers."""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, db, cleanup_interval=3600):
+        """Sessions are read and written through db; expired ones are deleted at most every cleanup_interval seconds."""
+        self.db = db
+        self.cleanup_interval = cleanup_interval
+        self._cleaned = time.monotonic()
+
+    def open_session(self, app, request):
+        # look up unexpired session from cookie
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            rows = self.db.execute("SELECT data \
+                                   FROM sessions \
+                                   WHERE session_id = :session_id \
+                                   AND expires_dt > :now;", session_id=sid, now=_utc())
+            if rows:
+                return DatabaseSession(self.serializer.loads(rows[0]["data"]), sid=sid)
+
+        # otherwise start a new one, stored only once something is put in it
+        return DatabaseSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        # emptied session (e.g. logout) is deleted along with its cookie
+        if not session:
+            if session.modified and not session.new:
+                self.db.execute("DELETE FROM sessions \
+                                WHERE session_id = :session_id;", session_id=session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # unchanged sessions cost no write
+        if not session.modified:
+            return
+
+        # a cleared session or one changing user gets a new id, so an id planted before login is worthless after it
+        if not session.new and (session.cleared or session.get("user_id") != session.user_id):
+            self.db.execute("DELETE FROM sessions \
+                            WHERE session_id = :session_id;", session_id=session.sid)
+            session.sid = secrets.token_urlsafe(32)
+
+        # upsert data with expiry
+        expires = _utc(app.permanent_session_lifetime)
+        self.db.execute("INSERT INTO sessions (session_id, data, expires_dt) \
+                        VALUES(:session_id, :data, :expires_dt) \
+                        ON CONFLICT (session_id) DO UPDATE \
+                        SET data = excluded.data \
+                        ,expires_dt = excluded.expires_dt;",
+                        session_id=session.sid, data=self.serializer.dumps(dict(session)), expires_dt=expires)
+
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+        # periodically delete expired sessions in bulk
+        if time.monotonic() - self._cleaned > self.cleanup_interval:
+            self.cleanup()
+
+    def cleanup(self):
+        """Deletes all expired sessions, returns number deleted."""
+        self._cleaned = time.monotonic()
+        return self.db.execute("DELETE FROM sessions \
+                               WHERE expires_dt <= :now;", now=_utc())
+
+
+def _utc(delta=None):
+    """Returns UTC time (plus delta) as an ISO string, which compares correctly on every backend."""
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    if delta is not None:
+        now += delta
+    return now.isoformat(" ")
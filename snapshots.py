@@ -0,0 +1,54 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+
+
+class SnapshotCache(object):
+    """Keep computed dashboards (balances and scheduled items) per user in process memory, evicting the least recently used."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version=None):
+        """
+        Returns copies of user_id's (balances, scheduled), or None if there is no snapshot,
+        it was computed on an earlier day (schedule buckets roll over at midnight) or, if version is given,
+        at a different version of the user's data.
+        """
+        today = date.today()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] != today or (version is not None and entry[1] != version):
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+
+        # callers format in place, so hand out copies
+        return dict(entry[2]), [dict(item) for item in entry[3]]
+
+    def put(self, user_id, version, balances, scheduled):
+        """Stores copies of user_id's balances and scheduled items, computed at version."""
+        entry = (date.today(), version, dict(balances), [dict(item) for item in scheduled])
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drops user_id's snapshot, e.g. after a write."""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Drops all snapshots."""
+        with self._lock:
+            self._entries.clear()
+
+
+# shared by all requests in this process
+snapshots = SnapshotCache()
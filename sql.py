@@ -1,27 +1,58 @@
-import datetime
-import decimal
+import collections
+import contextlib
+import contextvars
 import logging
 import os
 import re
-import sqlalchemy
-import sqlite3
-import sqlparse
-import sys
-import termcolor
+import threading
+import time
 import warnings
 
+import dialects
+from metrics import Histogram, add_timing, fingerprint
+
 
 class SQL(object):
     """Wrap SQLAlchemy to provide a simple SQL API."""
 
+    # Maximum number of distinct statements to keep parsed
+    STATEMENT_CACHE_SIZE = 512
+
     def __init__(self, url, **kwargs):
         """
         Create instance of sqlalchemy.engine.Engine.
         URL should be a string that indicates database dialect and connection arguments.
         http://docs.sqlalchemy.org/en/latest/core/engines.html#sqlalchemy.create_engine
         http://docs.sqlalchemy.org/en/latest/dialects/index.html
+
+        Statements are logged according to log, one of "off", "plain" (one line per
+        statement) or "pretty" (reindented, colorized on a TTY). If slow_query is a
+        number of seconds, only statements taking at least that long are logged, as
+warnings, in plain form if log is "off".
+
+        For SQLite (3.35 or later), foreign_keys enables foreign key constraints and wal write-ahead logging.
+
+        If metrics is a metrics.Registry, each statement's duration and rows are recorded
+        there, keyed by its fingerprint, along with the pool's timings.
         """
 
+        # Remember logging mode and slow-query threshold and remove them from kwargs
+        self._log_mode = kwargs.pop("log", "pretty")
+        if self._log_mode not in ("off", "plain", "pretty"):
+            raise RuntimeError("unsupported log mode: {}".format(self._log_mode))
+        self._slow_query = kwargs.pop("slow_query", None)
+
+        # A threshold alone still logs slow statements
+        if self._slow_query is not None and self._log_mode == "off":
+            self._log_mode = "plain"
+        self._metrics = kwargs.pop("metrics", None)
+
+        # Create the engine on first use (or warmup) rather than now, e.g. to keep imports and startup cheap
+        lazy = kwargs.pop("lazy", False)
+        self._url = url
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
         # Require that file already exist for SQLite
         matches = re.search(r"^sqlite:///(.+)$", url)
         if matches:
@@ -30,38 +61,133 @@ class SQL(object):
             if not os.path.isfile(matches.group(1)):
                 raise RuntimeError("not a file: {}".format(matches.group(1)))
 
-            # Remember foreign_keys and remove it from kwargs
-            foreign_keys = kwargs.pop("foreign_keys", False)
+            # Queries use RETURNING (SQLite 3.35) and UPDATE ... FROM (3.33)
+            import sqlite3
+            if sqlite3.sqlite_version_info < (3, 35, 0):
+                raise RuntimeError("requires SQLite 3.35 or later, found {}".format(sqlite3.sqlite_version))
 
-            # Create engine, raising exception if back end's module not installed
-            self.engine = sqlalchemy.create_engine(url, **kwargs)
-
-            # Enable foreign key constraints
-            if foreign_keys:
-                sqlalchemy.event.listen(self.engine, "connect", _connect)
+            # Remember foreign_keys and wal and remove them from kwargs
+            self._foreign_keys = kwargs.pop("foreign_keys", False)
+            self._wal = kwargs.pop("wal", False)
 
         else:
+            self._foreign_keys = self._wal = False
+
+            # Send executemany batches to PostgreSQL in pages via psycopg2's execute_batch, not one round trip per row
+            # https://docs.sqlalchemy.org/en/13/dialects/postgresql.html#psycopg2-batch-mode-fast-execution
+            if re.search(r"^postgres(?:ql)?(?:\+psycopg2)?://", url):
+                kwargs.setdefault("executemany_mode", "batch")
+
+        # Remaining arguments are for create_engine
+        self._kwargs = kwargs
+
+        # Parsed statements, keyed by SQL text
+        self._statements = {}
 
-            # Create engine, raising exception if back end's module not installed
-            self.engine = sqlalchemy.create_engine(url, **kwargs)
+        # Connection of the current thread's transaction, if any
+        self._local = threading.local()
 
+        # Backend name from the URL's scheme, e.g. postgresql for postgresql+psycopg2://
+        backend = re.match(r"^(\w+)", url).group(1)
+        self._postgres = backend in ["postgres", "postgresql"]
 
-        # Log statements to standard error
-        logging.basicConfig(level=logging.DEBUG)
+        # Backend-specific SQL for portable statements (None if unsupported)
+        self.dialect = dialects.DIALECTS.get(backend)
+
+        # Pool metrics: time spent waiting for a checkout and opening new connections
+        self._checkout_wait = Histogram()
+        self._connect_latency = Histogram()
+        self._connecting = threading.local()
+        if self._metrics is not None:
+            self._metrics.register("sql_pool_checkout_wait_seconds", "Time waiting to check a connection out of the pool.",
+                                   self._checkout_wait)
+            self._metrics.register("sql_pool_connect_seconds", "Time opening new database connections.", self._connect_latency)
+
+        # Log statements to standard error, without touching the root logger
         self.logger = logging.getLogger("cs50")
-        disabled = self.logger.disabled
+        self._color = False
+        if self._log_mode != "off":
+            self.logger.setLevel(logging.DEBUG)
+            if not self.logger.handlers:
+                self.logger.addHandler(logging.StreamHandler())
+                self.logger.propagate = False
+
+            # Only colorize output that goes to a terminal
+            stream = getattr(self.logger.handlers[0], "stream", None)
+            self._color = self._log_mode == "pretty" and stream is not None and stream.isatty()
 
         # Test database
+        if not lazy:
+            self.warmup()
+
+    @property
+    def engine(self):
+        """The sqlalchemy.engine.Engine, created on first use."""
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+        return self._engine
+
+    def _create_engine(self):
+        """Creates the engine with its event listeners, raising exception if back end's module not installed."""
+        import sqlalchemy
+        engine = sqlalchemy.create_engine(self._url, **self._kwargs)
+
+        # Enable foreign key constraints
+        if self._foreign_keys:
+            sqlalchemy.event.listen(engine, "connect", _connect)
+
+        # Let readers run alongside a writer
+        if self._wal:
+            sqlalchemy.event.listen(engine, "connect", _wal)
+
+        sqlalchemy.event.listen(engine, "do_connect", self._on_do_connect)
+        sqlalchemy.event.listen(engine, "connect", self._on_connect)
+        return engine
+
+    def warmup(self):
+        """Creates the engine and connects, raising RuntimeError if the database can't be reached."""
+        disabled = self.logger.disabled
         try:
             self.logger.disabled = True
             self.execute("SELECT 1")
-        except sqlalchemy.exc.OperationalError as e:
-            e = RuntimeError(self._parse(e))
-            e.__cause__ = None
-            raise e
-        else:
+        finally:
             self.logger.disabled = disabled
 
+    def _on_do_connect(self, dialect, connection_record, cargs, cparams):
+        """Remembers when the dialect starts opening a new connection."""
+        self._connecting.start = time.perf_counter()
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        """Records how long opening a new connection took."""
+        start = getattr(self._connecting, "start", None)
+        if start is not None:
+            self._connect_latency.observe(time.perf_counter() - start)
+            self._connecting.start = None
+
+    def _checkout(self):
+        """Checks a connection out of the pool, recording how long that took."""
+        start = time.perf_counter()
+        connection = self.engine.connect()
+        self._checkout_wait.observe(time.perf_counter() - start)
+        return connection
+
+    def pool_status(self):
+        """Returns live pool state plus checkout wait and connect latency histograms as a dict."""
+        pool = self.engine.pool
+        status = {"pool": type(pool).__name__}
+
+        # QueuePool reports size and usage, other pools (e.g. SQLite's) may not
+        for name in ["size", "checkedin", "checkedout", "overflow"]:
+            method = getattr(pool, name, None)
+            if method is not None:
+                status[name] = method()
+
+        status["checkout_wait"] = self._checkout_wait.snapshot()
+        status["connect_latency"] = self._connect_latency.snapshot()
+        return status
+
     def _parse(self, e):
         """Parses an exception, returns its message."""
 
@@ -83,152 +209,555 @@ class SQL(object):
         # Default
         return str(e)
 
-    def execute(self, text, **params):
-        """Execute a SQL statement."""
-
-        class UserDefinedType(sqlalchemy.TypeDecorator):
-            """Add support for expandable values, a la https://github.com/sqlalchemy/sqlalchemy/issues/3953."""
+    def _log(self, statement, params, color, elapsed):
+        """Logs a statement, formatting it only if a record will be emitted."""
 
-            # Required class-level attribute
-            # https://docs.sqlalchemy.org/en/latest/core/custom_types.html#sqlalchemy.types.TypeDecorator
-            impl = sqlalchemy.types.UserDefinedType
+        # Nothing to emit
+        if self._log_mode == "off" or self.logger.disabled:
+            return
+        if self._slow_query is not None:
+            if elapsed < self._slow_query:
+                return
+            level = logging.WARNING
+        else:
+            level = logging.DEBUG
+        if not self.logger.isEnabledFor(level):
+            return
+
+        # Format statement once, then remember it
+        if statement.log is None:
+            if self._log_mode == "pretty":
+                import sqlparse
+                statement.log = re.sub(r"\n\s*", " ", sqlparse.format(statement.text, reindent=True))
+            else:
+                statement.log = " ".join(statement.text.split())
+
+        log = "{} {} [{:.1f} ms]".format(statement.log, params, elapsed * 1000)
+        if self._color:
+            import termcolor
+            log = termcolor.colored(log, color)
+        self.logger.log(level, log)
+
+    def _observe(self, statement, elapsed, rows):
+        """Records a statement's duration and rows in the registry, and its time in the current request's breakdown."""
+
+        add_timing("db", elapsed)
+        for statements in _counting.get():
+            statements.append(statement.text)
+        if self._metrics is None:
+            return
+
+        # Look metrics up once per statement
+        if statement.metrics is None:
+            digest, normalized = fingerprint(statement.text)
+            self._metrics.info("sql_statement_info", "Normalized text of each statement fingerprint.",
+                               fingerprint=digest, statement=normalized)
+            statement.metrics = (
+                self._metrics.histogram("sql_statement_duration_seconds", "Statement execution time.", fingerprint=digest),
+                self._metrics.counter("sql_statement_rows_total", "Rows returned or affected by statements.", fingerprint=digest))
+
+        duration, total = statement.metrics
+        duration.observe(elapsed)
+        total.inc(rows)
+
+    def _prepare(self, text, params, many=False):
+        """Returns the cached statement for text, parsing it on first use."""
+
+        # Lists are bound as expanding parameters, so they are part of the key
+        expanding = tuple(sorted(key for key, value in params.items() if type(value) in (list, tuple)))
+        key = (text, expanding, many)
+        statement = self._statements.get(key)
+        if statement is not None:
+            return statement
+
+        import sqlalchemy
+        import sqlparse
 
-            def process_literal_param(self, value, dialect):
-                """Receive a literal parameter value to be rendered inline within a statement."""
+        # Allow only one statement at a time, since SQLite doesn't support multiple
+        # https://docs.python.org/3/library/sqlite3.html#sqlite3.Cursor.execute
+        statements = sqlparse.split(text)
+        if len(statements) > 1:
+            raise RuntimeError("too many statements at once")
 
-                def process(value):
-                    """Render a literal value, escaping as needed."""
+        # Classify as SELECT, INSERT, UPDATE, DELETE or UNKNOWN
+        parsed = sqlparse.parse(statements[0]) if statements else []
+        kind = parsed[0].get_type() if parsed else "UNKNOWN"
 
-                    # bool
-                    if type(value) is bool:
-                        return sqlalchemy.types.Boolean().literal_processor(dialect)(value)
+        # Statements with a RETURNING clause return rows, whatever their type
+        if re.search(r"\bRETURNING\b", text, re.I):
+            returning = "rows"
 
-                    # datetime.date
-                    elif type(value) is datetime.date:
-                        return sqlalchemy.types.String().literal_processor(dialect)(value.strftime("%Y-%m-%d"))
+        # On PostgreSQL, return the new primary key from the INSERT itself instead of a second SELECT LASTVAL()
+        elif kind == "INSERT" and self._postgres and not many:
+            primary_key = self._primary_key(text)
+            if primary_key:
+                text = "{} RETURNING {}".format(text.rstrip().rstrip(";"), primary_key)
+                returning = "key"
+            else:
+                returning = None
+        else:
+            returning = None
 
-                    # datetime.datetime
-                    elif type(value) is datetime.datetime:
-                        return sqlalchemy.types.String().literal_processor(dialect)(value.strftime("%Y-%m-%d %H:%M:%S"))
+        # Construct TextClause once, marking list parameters as expanding
+        # https://docs.sqlalchemy.org/en/13/core/sqlelement.html#sqlalchemy.sql.expression.bindparam.params.expanding
+        clause = sqlalchemy.text(text)
+        if expanding:
+            clause = clause.bindparams(*[sqlalchemy.bindparam(name, expanding=True) for name in expanding])
 
-                    # datetime.time
-                    elif type(value) is datetime.time:
-                        return sqlalchemy.types.String().literal_processor(dialect)(value.strftime("%H:%M:%S"))
+        statement = _Statement(text, clause, kind, returning)
 
-                    # float
-                    elif type(value) is float:
-                        return sqlalchemy.types.Float().literal_processor(dialect)(value)
+        # Bound cache, since callers could in principle build SQL dynamically
+        if len(self._statements) < self.STATEMENT_CACHE_SIZE:
+            self._statements[key] = statement
+        return statement
 
-                    # int
-                    elif type(value) is int:
-                        return sqlalchemy.types.Integer().literal_processor(dialect)(value)
+    def execute(self, text, **params):
+        """Execute a SQL statement."""
 
-                    # long
-                    elif sys.version_info.major != 3 and type(value) is long:
-                        return sqlalchemy.types.Integer().literal_processor(dialect)(value)
+        # Parse, validate and classify statement (cached by text)
+        statement = self._prepare(text, params)
 
-                    # str
-                    elif type(value) is str:
-                        return sqlalchemy.types.String().literal_processor(dialect)(value)
+        return self._run(statement, params, self._result)
 
-                    # None
-                    elif type(value) is sqlalchemy.sql.elements.Null:
-                        return sqlalchemy.types.NullType().literal_processor(dialect)(value)
+    def executemany(self, text, rows):
+        """Execute a SQL statement once per dict of parameters in rows, as a single batch; returns number of rows affected."""
 
-                    # Unsupported value
-                    raise RuntimeError("unsupported value")
+        rows = list(rows)
+        if not rows:
+            return 0
 
-                # Process value(s), separating with commas as needed
-                if type(value) is list:
-                    return ", ".join([process(v) for v in value])
-                else:
-                    return process(value)
+        # Parse once, without adding a RETURNING clause the driver would discard
+        statement = self._prepare(text, rows[0], many=True)
 
-        # Allow only one statement at a time, since SQLite doesn't support multiple
-        # https://docs.python.org/3/library/sqlite3.html#sqlite3.Cursor.execute
-        if len(sqlparse.split(text)) > 1:
-            raise RuntimeError("too many statements at once")
+        return self._run(statement, rows, lambda connection, statement, rows: connection.execute(statement.clause, rows).rowcount)
 
-        # Raise exceptions for warnings
-        warnings.filterwarnings("error")
+    def records(self, text, **params):
+        """Execute a SELECT (or statement with RETURNING), returning rows as lightweight namedtuple records instead of dicts."""
 
-        # Prepare, execute statement
-        try:
+        statement = self._prepare(text, params)
 
-            # Construct a new TextClause clause
-            statement = sqlalchemy.text(text)
+        def run(connection, statement, params):
+            result = connection.execute(statement.clause, params)
+            Record, decimals = self._record(statement, result), self._decimals(result)
+            return list(map(Record._make, self._rows(decimals, result.fetchall())))
 
-            # Iterate over parameters
-            for key, value in params.items():
+        return self._run(statement, params, run)
 
-                # Translate None to NULL
-                if value is None:
-                    value = sqlalchemy.sql.null()
+    def iterate(self, text, size=1000, **params):
+        """
+        Execute a SELECT, yielding rows as namedtuple records while fetching size rows at a time.
+        Uses a server-side cursor where the driver supports one (e.g. psycopg2), so memory stays flat for large results.
+        """
 
-                # Bind parameters before statement reaches database, so that bound parameters appear in exceptions
-                # http://docs.sqlalchemy.org/en/latest/core/sqlelement.html#sqlalchemy.sql.expression.text
-                statement = statement.bindparams(sqlalchemy.bindparam(
-                    key, value=value, type_=UserDefinedType()))
+        import sqlalchemy
+        statement = self._prepare(text, params)
+        start = time.perf_counter()
+
+        # Use the current transaction's connection, else hold one for as long as rows are consumed
+        connection = getattr(self._local, "connection", None)
+        with contextlib.ExitStack() as stack:
+            if connection is None:
+                connection = stack.enter_context(self._checkout())
+            try:
+                result = connection.execution_options(stream_results=True).execute(statement.clause, params)
+            except sqlalchemy.exc.OperationalError as e:
+                self._log(statement, params, "red", time.perf_counter() - start)
+                e = RuntimeError(self._parse(e))
+                e.__cause__ = None
+                raise e
+            self._log(statement, params, "green", time.perf_counter() - start)
+
+            Record, decimals = self._record(statement, result), self._decimals(result)
+            rows = 0
+            try:
+                while True:
+                    chunk = result.fetchmany(size)
+                    if not chunk:
+                        break
+                    rows += len(chunk)
+                    yield from map(Record._make, self._rows(decimals, chunk))
+            finally:
+                self._observe(statement, time.perf_counter() - start, rows)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run every execute in the block on one connection, in one transaction.
+        Commits when the block finishes, rolls back if it raises. Nested blocks join the outer transaction.
+        Note that execute returns None on a constraint violation; on PostgreSQL the transaction is then aborted,
+        so the block should stop issuing statements.
+        """
 
-            # Stringify bound parameters
-            # http://docs.sqlalchemy.org/en/latest/faq/sqlexpressions.html#how-do-i-render-sql-expressions-as-strings-possibly-with-bound-parameters-inlined
-            statement = str(statement.compile(compile_kwargs={"literal_binds": True}))
+        # Join an enclosing transaction
+        if getattr(self._local, "connection", None) is not None:
+            yield
+            return
+
+        with self._checkout() as connection:
+            with connection.begin():
+                self._local.connection = connection
+                try:
+                    yield
+                finally:
+                    self._local.connection = None
+
+    @contextlib.contextmanager
+    def counting(self, limit=None):
+        """
+        Collect the text of every statement run in the block (by this thread or task, including AsyncSQL
+        awaited from it) into the list it yields, e.g. to measure queries per action. Blocks may nest.
+        If limit is given, raises RuntimeError when the block ran more statements than that.
+        """
 
-            # Statement for logging
-            log = re.sub(r"\n\s*", " ", sqlparse.format(statement, reindent=True))
+        statements = []
+        token = _counting.set(_counting.get() + (statements,))
+        try:
+            yield statements
+        finally:
+            _counting.reset(token)
+        if limit is not None and len(statements) > limit:
+            raise RuntimeError("{} statements run, expected at most {}: {}".format(
+                len(statements), limit, "; ".join(" ".join(text.split())[:80] for text in statements)))
 
-            # Execute statement
-            result = self.engine.execute(statement)
+    def _run(self, statement, params, run):
+        """Runs statement with params via run(connection, statement, params), logging it and translating errors."""
+        import sqlalchemy
 
-            # If SELECT (or INSERT with RETURNING), return result set as list of dict objects
-            if re.search(r"^\s*SELECT", statement, re.I):
+        # Raise exceptions for warnings
+        warnings.filterwarnings("error")
 
-                # Coerce any decimal.Decimal objects to float objects
-                # https://groups.google.com/d/msg/sqlalchemy/0qXMYJvq8SA/oqtvMD9Uw-kJ
-                rows = [dict(row) for row in result.fetchall()]
-                for row in rows:
-                    for column in row:
-                        if type(row[column]) is decimal.Decimal:
-                            row[column] = float(row[column])
-                ret = rows
+        # Batches are logged by size only
+        shown = params if isinstance(params, dict) else "[{} rows]".format(len(params))
 
-            # If INSERT, return primary key value for a newly inserted row
-            elif re.search(r"^\s*INSERT", statement, re.I):
-                if self.engine.url.get_backend_name() in ["postgres", "postgresql"]:
-                    result = self.engine.execute(sqlalchemy.text("SELECT LASTVAL()"))
-                    ret = result.first()[0]
-                else:
-                    ret = result.lastrowid
+        # Execute statement, letting the driver bind parameters
+        start = time.perf_counter()
+        try:
 
-            # If DELETE or UPDATE, return number of rows matched
-            elif re.search(r"^\s*(?:DELETE|UPDATE)", statement, re.I):
-                ret = result.rowcount
+            # Inside a transaction, use its connection
+            connection = getattr(self._local, "connection", None)
+            if connection is not None:
+                ret = run(connection, statement, params)
 
-            # If some other statement, return True unless exception
             else:
-                ret = True
+                with self._checkout() as connection:
+
+                    # Fetch RETURNING rows before committing, as SQLite can't commit with a cursor open
+                    if statement.returning:
+                        with connection.begin():
+                            ret = run(connection, statement, params)
+                    else:
+                        ret = run(connection, statement, params)
 
         # If constraint violated, return None
         except sqlalchemy.exc.IntegrityError:
-            self.logger.debug(termcolor.colored(log, "yellow"))
+            elapsed = time.perf_counter() - start
+            self._log(statement, shown, "yellow", elapsed)
+            self._observe(statement, elapsed, 0)
             return None
 
         # If user errror
         except sqlalchemy.exc.OperationalError as e:
-            self.logger.debug(termcolor.colored(log, "red"))
+            elapsed = time.perf_counter() - start
+            self._log(statement, shown, "red", elapsed)
+            self._observe(statement, elapsed, 0)
             e = RuntimeError(self._parse(e))
             e.__cause__ = None
             raise e
 
         # Return value
         else:
-            self.logger.debug(termcolor.colored(log, "green"))
+            elapsed = time.perf_counter() - start
+            self._log(statement, shown, "green", elapsed)
+            self._observe(statement, elapsed, _rowcount(statement, params, ret))
             return ret
 
+    def _decimals(self, result):
+        """
+        Returns indexes of columns the driver returns as decimal.Decimal, decided once per result set from the cursor description.
+        https://groups.google.com/d/msg/sqlalchemy/0qXMYJvq8SA/oqtvMD9Uw-kJ
+        """
+        description = result.cursor.description or []
+        return [i for i, column in enumerate(description) if column[1] in _DECIMAL_TYPE_CODES]
+
+    def _rows(self, decimals, rows):
+        """Returns rows as tuples, coercing columns decimals to float column by column."""
+        if not decimals or not rows:
+            return [tuple(row) for row in rows]
+
+        columns = list(zip(*rows))
+        for i in decimals:
+            columns[i] = [None if value is None else float(value) for value in columns[i]]
+        return list(zip(*columns))
+
+    def _record(self, statement, result):
+        """Returns the namedtuple class for statement's columns, creating it on first use."""
+
+        keys = tuple(result.keys())
+        if statement.record is None or statement.record._fields != keys:
+            statement.record = collections.namedtuple("Record", keys, rename=True)
+        return statement.record
+
+    def _primary_key(self, text):
+        """Returns the single-column primary key of the table an INSERT targets, else None."""
+
+        import sqlalchemy
+        matches = re.search(r"^\s*INSERT\s+INTO\s+(?:(\w+)\.)?(\w+)", text, re.I)
+        if not matches:
+            return None
+
+        # Inside a transaction, read the catalog on its connection rather than checking out a second one
+        bind = getattr(self._local, "connection", None)
+        columns = sqlalchemy.inspect(bind if bind is not None else self.engine).get_pk_constraint(
+            matches.group(2), schema=matches.group(1)).get("constrained_columns", [])
+        return columns[0] if len(columns) == 1 else None
+
+    def _result(self, connection, statement, params):
+        """Executes statement on connection, returns its result in the form execute promises."""
+
+        result = connection.execute(statement.clause, params)
+
+        # If SELECT (or statement with RETURNING), return result set as list of dict objects
+        if statement.kind == "SELECT" or statement.returning == "rows":
+
+            keys, decimals = result.keys(), self._decimals(result)
+            return [dict(zip(keys, row)) for row in self._rows(decimals, result.fetchall())]
+
+        # If INSERT, return primary key value for a newly inserted row
+        elif statement.kind == "INSERT":
+
+            # Key came back from the statement's own RETURNING clause (None if nothing was inserted)
+            if statement.returning == "key":
+                row = result.first()
+                return row[0] if row else None
+
+            # Otherwise ask the same connection, so a concurrent insert can't interfere
+            elif self._postgres:
+                import sqlalchemy
+                return connection.execute(sqlalchemy.text("SELECT LASTVAL()")).first()[0]
+            else:
+                return result.lastrowid
+
+        # If DELETE or UPDATE, return number of rows matched
+        elif statement.kind in ["DELETE", "UPDATE"]:
+            return result.rowcount
+
+        # If some other statement, return True unless exception
+        else:
+            return True
+
+
+class AsyncSQL(object):
+    """
+    Awaitable counterpart of SQL with the same execute(text, **params) API, so a request can run queries concurrently.
+
+    Statements are parsed, classified and logged by the wrapped SQL instance. With driver "thread" (the default),
+    each execute runs SQL.execute in a worker thread on the sync pool. With driver "psycopg" (PostgreSQL only),
+    statements run on a psycopg 3 AsyncConnectionPool of min_size to max_size connections, driven by an event
+    loop in a background thread, so it serves every caller whatever loop it awaits from. The pool is opened
+    on first use. Each execute runs in its own transaction; use SQL.transaction for several statements.
+    """
+
+    def __init__(self, db, driver="thread", min_size=1, max_size=10):
+        self._sql = db
+        self.driver = driver
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        if driver == "psycopg":
+            if not db._postgres:
+                raise RuntimeError("psycopg driver requires PostgreSQL")
+        elif driver != "thread":
+            raise RuntimeError("unsupported async driver: {}".format(driver))
+
+    def _open(self):
+        """Starts the pool's loop and opens the pool, returning the pool."""
+        import asyncio
+
+        # Imported here, since the thread driver needs neither
+        import psycopg
+        import psycopg_pool
+        self._errors = psycopg
+
+        # Pool lives on its own loop, as asyncio pools can't be shared across loops
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="async-sql", daemon=True).start()
+        conninfo = re.sub(r"^postgres(?:ql)?(?:\+\w+)?://", "postgresql://", self._sql._url)
+
+        async def open():
+            pool = psycopg_pool.AsyncConnectionPool(conninfo, min_size=self.min_size, max_size=self.max_size, open=False)
+            await pool.open(wait=True)
+            return pool
+
+        return asyncio.run_coroutine_threadsafe(open(), self._loop).result()
+
+    @property
+    def dialect(self):
+        """The wrapped SQL instance's dialect."""
+        return self._sql.dialect
+
+    async def execute(self, text, **params):
+        """Execute a SQL statement, returning what SQL.execute would."""
+        import asyncio
+
+        if self.driver == "thread":
+            return await asyncio.to_thread(self._sql.execute, text, **params)
+
+        # Open the pool on first use
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = self._open()
+
+        # Parse, validate and classify statement (cached by text, shared with the sync path)
+        statement = self._sql._prepare(text, params)
+        start = time.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(self._run(statement, params), self._loop)
+        ret = await asyncio.wrap_future(future)
+
+        # Recorded here, as the pool's loop doesn't see the caller's request
+        self._sql._observe(statement, time.perf_counter() - start, _rowcount(statement, params, ret))
+        return ret
+
+    async def _run(self, statement, params):
+        """Runs statement on a pooled connection, logging it and translating errors as SQL._run does."""
+
+        query, values = _pyformat(statement.text, params)
+        start = time.perf_counter()
+        try:
+            async with self._pool.connection() as connection:
+                cursor = await connection.execute(query, values)
+
+                # If SELECT (or statement with RETURNING), return result set as list of dict objects
+                if statement.kind == "SELECT" or statement.returning == "rows":
+                    description = cursor.description or []
+                    keys = [column.name for column in description]
+                    decimals = [i for i, column in enumerate(description) if column.type_code in _DECIMAL_TYPE_CODES]
+                    ret = [dict(zip(keys, row)) for row in self._sql._rows(decimals, await cursor.fetchall())]
+
+                # If INSERT, return primary key value for a newly inserted row
+                elif statement.kind == "INSERT":
+                    if statement.returning == "key":
+                        row = await cursor.fetchone()
+                        ret = row[0] if row else None
+                    else:
+                        ret = (await (await connection.execute("SELECT LASTVAL()")).fetchone())[0]
+
+                # If DELETE or UPDATE, return number of rows matched
+                elif statement.kind in ["DELETE", "UPDATE"]:
+                    ret = cursor.rowcount
+
+                # If some other statement, return True unless exception
+                else:
+                    ret = True
+
+        # If constraint violated, return None
+        except self._errors.IntegrityError:
+            self._sql._log(statement, params, "yellow", time.perf_counter() - start)
+            return None
+
+        # If user errror
+        except self._errors.OperationalError as e:
+            self._sql._log(statement, params, "red", time.perf_counter() - start)
+            e = RuntimeError(str(e))
+            e.__cause__ = None
+            raise e
+
+        self._sql._log(statement, params, "green", time.perf_counter() - start)
+        return ret
+
+    def close(self):
+        """Closes the pool's connections and stops its loop."""
+        import asyncio
+        if self._pool is not None:
+            asyncio.run_coroutine_threadsafe(self._pool.close(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._pool = None
+
+
+# Named parameters as SQLAlchemy's text() finds them, skipping :: casts
+# https://docs.sqlalchemy.org/en/13/core/sqlelement.html#sqlalchemy.sql.expression.text
+_BIND_PARAMS = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+
+
+def _pyformat(text, params):
+    """Returns text with :name parameters as psycopg %(name)s placeholders, expanding lists as SQL.execute does."""
+
+    values = {}
+
+    def placeholder(matches):
+        name = matches.group(1)
+        value = params[name]
+        if type(value) not in (list, tuple):
+            values[name] = value
+            return "%({})s".format(name)
+
+        # Lists become one placeholder per element, matching nothing when empty
+        if not value:
+            return "(SELECT NULL WHERE 1 = 0)"
+        names = ["{}_{}".format(name, i) for i in range(len(value))]
+        values.update(zip(names, value))
+        return "({})".format(", ".join("%({})s".format(n) for n in names))
+
+    return _BIND_PARAMS.sub(placeholder, text.replace("%", "%%")), values
+
+
+# Statement lists of the enclosing counting blocks
+_counting = contextvars.ContextVar("counting", default=())
+
+
+def _rowcount(statement, params, ret):
+    """Returns the number of rows a statement returned or affected, given what execute (or executemany) returned."""
+    if isinstance(ret, list):
+        return len(ret)
+    if not isinstance(params, dict) or statement.kind in ["DELETE", "UPDATE"]:
+        return ret or 0
+    if statement.kind == "INSERT":
+        return 0 if ret is None else 1
+    return 0
+
+
+# DBAPI type codes of columns returned as decimal.Decimal: PostgreSQL NUMERIC (psycopg2), MySQL DECIMAL and NEWDECIMAL;
+# SQLite never returns decimal.Decimal
+_DECIMAL_TYPE_CODES = {1700, 0, 246}
+
+
+class _Statement(object):
+    """A parsed, validated and classified statement, cached by SQL text."""
+
+    __slots__ = ("text", "clause", "kind", "returning", "log", "record", "metrics")
+
+    def __init__(self, text, clause, kind, returning):
+        self.text = text
+        self.clause = clause
+        self.kind = kind
+        self.returning = returning
+        self.log = None
+        self.record = None
+        self.metrics = None
+
+
+def pool_options(environ=os.environ):
+    """
+    Returns create_engine pool arguments set in environ, to size the pool against gunicorn workers and threads.
+    https://docs.sqlalchemy.org/en/13/core/engines.html#sqlalchemy.create_engine
+    """
+    options = {}
+    for variable, name, cast in [("DB_POOL_SIZE", "pool_size", int),
+                                 ("DB_MAX_OVERFLOW", "max_overflow", int),
+                                 ("DB_POOL_TIMEOUT", "pool_timeout", float),
+                                 ("DB_POOL_RECYCLE", "pool_recycle", int),
+                                 ("DB_POOL_PRE_PING", "pool_pre_ping", lambda value: value.lower() in ["1", "true", "yes"])]:
+        if environ.get(variable):
+            options[name] = cast(environ[variable])
+    return options
+
 
 # http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#foreign-key-support
 def _connect(dbapi_connection, connection_record):
     """Enables foreign key support."""
+    import sqlite3
 
     # If back end is sqlite
     if type(dbapi_connection) is sqlite3.Connection:
@@ -236,4 +765,19 @@ def _connect(dbapi_connection, connection_record):
         # Respect foreign key constraints by default
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
\ No newline at end of file
+        cursor.close()
+
+
+# https://www.sqlite.org/wal.html
+def _wal(dbapi_connection, connection_record):
+    """Enables write-ahead logging."""
+    import sqlite3
+
+    # If back end is sqlite
+    if type(dbapi_connection) is sqlite3.Connection:
+
+        # WAL persists in the file; NORMAL sync is durable enough with it and avoids an fsync per commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
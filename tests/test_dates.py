@@ -0,0 +1,68 @@
+"""
+SQLite's date arithmetic (SQLiteDialect.advance) and the forecast's (forecast.occurrences) against PostgreSQL's
+interval behaviour: months and years keep the day of month, clamped to the last day of shorter months.
+"""
+
+import sqlite3
+from datetime import date
+
+import pytest
+
+from dialects import DIALECTS
+from forecast import occurrences
+
+
+# (date, count, unit, what PostgreSQL's date + (count || ' ' || unit)::INTERVAL gives)
+CASES = [
+    ("2021-01-31", 1, "months", "2021-02-28"),
+    ("2020-01-31", 1, "months", "2020-02-29"),
+    ("2021-03-31", 1, "months", "2021-04-30"),
+    ("2021-01-31", 2, "months", "2021-03-31"),
+    ("2021-12-31", 2, "months", "2022-02-28"),
+    ("2021-01-15", 13, "months", "2022-02-15"),
+    ("2020-02-29", 1, "years", "2021-02-28"),
+    ("2020-02-29", 4, "years", "2024-02-29"),
+    ("2021-06-30", 1, "years", "2022-06-30"),
+    ("2021-01-31", 14, "days", "2021-02-14"),
+    ("2020-02-28", 1, "days", "2020-02-29"),
+    ("2021-12-25", 7, "days", "2022-01-01"),
+]
+
+
+@pytest.fixture
+def sqlite():
+    connection = sqlite3.connect(":memory:")
+    yield connection
+    connection.close()
+
+
+def advance(connection, dt, count, unit):
+    expression = DIALECTS["sqlite"].advance(":dt", ":count", ":unit")
+    return connection.execute("SELECT " + expression, {"dt": dt, "count": count, "unit": unit}).fetchone()[0]
+
+
+@pytest.mark.parametrize("dt, count, unit, expected", CASES)
+def test_sqlite_advance(sqlite, dt, count, unit, expected):
+    assert advance(sqlite, dt, count, unit) == expected
+
+
+def test_sqlite_advance_one_time(sqlite):
+    # One Time frequencies have no modifier
+    assert advance(sqlite, "2021-01-31", 1, None) is None
+
+
+@pytest.mark.parametrize("dt, count, unit, expected", CASES)
+def test_occurrences(dt, count, unit, expected):
+    # the item's second occurrence is one step after its current_dt
+    item = {"current_dt": dt, "dt": dt, "amount": 1, "factor": 1, "repeat": 1, "n": count, "modifier": unit}
+    dates, _, _ = occurrences([item], date.fromisoformat(dt), date.fromisoformat(expected))
+    assert [str(d) for d in dates] == [dt, expected]
+
+
+def test_occurrences_match_sqlite(sqlite):
+    # every occurrence of a month-end item is current_dt plus k months, as PostgreSQL computes it, not a drifting day
+    item = {"current_dt": "2021-01-31", "dt": "2021-01-31", "amount": 1, "factor": 1, "repeat": 1, "n": 1,
+            "modifier": "months"}
+    dates, _, _ = occurrences([item], date(2021, 1, 1), date(2021, 12, 31))
+    assert [str(d) for d in dates] == [advance(sqlite, "2021-01-31", k, "months") for k in range(12)]
+    assert [str(d) for d in dates][1:4] == ["2021-02-28", "2021-03-31", "2021-04-30"]
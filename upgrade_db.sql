@@ -0,0 +1,24 @@
+-- tables and indexes added since the first deployment, created only where missing (see flask upgrade-db)
+
+CREATE INDEX IF NOT EXISTS ix_schedule_user_completed ON schedule (user_id, completed_dt);
+CREATE INDEX IF NOT EXISTS ix_schedule_user_type ON schedule (user_id, type_id);
+
+CREATE TABLE IF NOT EXISTS sessions
+(session_id TEXT PRIMARY KEY NOT NULL
+, data TEXT NOT NULL
+, expires_dt TIMESTAMP NOT NULL);
+
+CREATE INDEX IF NOT EXISTS ix_sessions_expires ON sessions (expires_dt);
+
+CREATE TABLE IF NOT EXISTS posting
+(posting_id SERIAL PRIMARY KEY NOT NULL
+, schedule_id INTEGER NOT NULL
+, user_id INTEGER NOT NULL
+, posted_dt DATE NOT NULL
+, amount NUMERIC
+, factor INTEGER
+, pmt_source TEXT
+, CONSTRAINT fk_posting_schedule FOREIGN KEY(schedule_id) REFERENCES schedule(schedule_id)
+, CONSTRAINT fk_posting_user FOREIGN KEY(user_id) REFERENCES users(user_id));
+
+CREATE INDEX IF NOT EXISTS ix_posting_user_posted ON posting (user_id, posted_dt, posting_id);